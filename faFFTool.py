@@ -24,16 +24,18 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 Frank Abelbeck Font File (faFF) tool chain: create/modify faFontFiles
 """
 
-import argparse,sys,os.path,PIL.Image,struct,pprint,PIL.ImageDraw
+import argparse,sys,os.path,PIL.Image,struct,pprint,PIL.ImageDraw,collections,array
 
 #-------------------------------------------------------------------------------
 # constants
 #-------------------------------------------------------------------------------
 
+# the FNV-1 hash is part of the file format: keep in sync with faFontFile.h/.c
 FNV1PRIME     = 0x01000193
 FNV1OFFSET    = 0x811c9dc5
 FNV1MASK      = 0x7fffffff # = 2**31-1, maximum value of int32_t
 MAXUCODE      = 0x10ffff
+UCODEREPLACEMENT = 0xfffd # Unicode replacement character, required in every font
 
 DEFAULTSUFFIX   = "bin"
 DEFAULTDISTANCE = 2
@@ -42,6 +44,9 @@ DEFAULTMARGIN   = 32
 RANGEMIN = 0
 RANGEMAX = 256
 
+# translation table for greyscale pixel data: 0 --> "0" (unset), 1..255 --> "1" (set)
+PIXELDIGITS = b"0" + b"1" * 255
+
 #-------------------------------------------------------------------------------
 # helper functions
 #-------------------------------------------------------------------------------
@@ -55,14 +60,23 @@ def hashFNV1(value,seed=FNV1OFFSET):
 	return seed
 
 
+def hashFNV1Code(code,seed=FNV1OFFSET):
+	# FNV-1 hash of a character code, equivalent to hashFNV1(code.to_bytes(3,"big"),seed)
+	# keys are always three bytes long, so the loop is unrolled (cf. faFontFile.c)
+	if seed == 0: seed = FNV1OFFSET
+	seed = ((seed * FNV1PRIME) & FNV1MASK) ^ ((code >> 16) & 0xff)
+	seed = ((seed * FNV1PRIME) & FNV1MASK) ^ ((code >> 8) & 0xff)
+	return ((seed * FNV1PRIME) & FNV1MASK) ^ (code & 0xff)
+
+
 def createMinimalPerfectHash(source):
 	#
 	# inspiration: http://stevehanov.ca/blog/?id=119
 	#
-	# 1) apply hashFNV1(key), put key in buckets
+	# 1) apply hashFNV1Code(key), put key in buckets
 	# 2) sort buckets, criterion: number of keys in bucket
 	# 3) process all buckets with more than one key:
-	#    start with seed=1, try all keys in bucket with hashFNV1(key,seed) until all keys fit into empty slots
+	#    start with seed=1, try all keys in bucket with hashFNV1Code(key,seed) until all keys fit into empty slots
 	# 4) process all buckets with just one key: place in remaining slots
 	#
 	nKeys = len(source) # number of keys to hash
@@ -70,85 +84,118 @@ def createMinimalPerfectHash(source):
 	nCollisions = 0 # statistics: count seed collisions
 	
 	buckets = [ [] for i in range(0,nKeys) ]
-	G = [0] * nKeys    # intermediate table with the seed for the second hash
-	V = [None] * nKeys # value table, initialised to None
+	G = array.array("i",[0]) * nKeys # intermediate table with the seed for the second hash (int32_t)
+	VKeys = array.array("l",[0]) * nKeys # value table, split into key codes...
+	VBits = [None] * nKeys               # ...and bitmaps, initialised to None
+	occupied = bytearray(nKeys) # occupancy map of the value table, one byte per slot
 	
 	# step 1) calculate hashes for all keys, put in buckets
-	for key in source.keys():
-		buckets[hashFNV1(key) % nKeys].append(key)
+	#         all keys are hashed with the default seed in one pass: hashFNV1Code()
+	#         is inlined and its first multiplication is shared by all keys
+	hashOffset = (FNV1OFFSET * FNV1PRIME) & FNV1MASK
+	indices = [
+		(((((((hashOffset ^ ((key >> 16) & 0xff)) * FNV1PRIME) & FNV1MASK) ^ ((key >> 8) & 0xff)) * FNV1PRIME) & FNV1MASK) ^ (key & 0xff)) % nKeys
+		for key in source.keys()
+	]
+	for key,index in zip(source.keys(),indices):
+		buckets[index].append(key)
 	
 	# step 2) sort buckets, criterion: number of keys in buckets, largest first
-	buckets.sort(key=len, reverse=True)
+	#         buckets are sorted by index: a bucket's index is the hash of its keys,
+	#         so the entry of the intermediate table is known without re-hashing
+	order = sorted(range(0,nKeys), key=lambda i: len(buckets[i]), reverse=True)
 	
 	# step 3) process buckets until only buckets with single key are left
-	while len(buckets) > 0 and len(buckets[0]) > 1:
-		bucket = buckets.pop(0)
+	#         walk the order by position instead of popping its first element
+	iOrder = 0
+	while iOrder < len(order) and len(buckets[order[iOrder]]) > 1:
+		origin = order[iOrder]
+		iOrder = iOrder + 1
+		bucket = buckets[origin]
 		seed = 1
 		k = 0
-		slots = []
+		slots = []          # slots marked to be used, in key order
+		slotsMarked = set() # same slots, for fast membership tests
 		
 		while k < len(bucket):
-			slot = hashFNV1(bucket[k],seed) % nKeys
-			if V[slot] is not None or slot in slots:
+			slot = hashFNV1Code(bucket[k],seed) % nKeys
+			if occupied[slot] or slot in slotsMarked:
 				# slot in value table already used or marked to be used:
 				# start again, with new seed
 				if seed >= FNV1MASK: raise ValueError("Hash seed exceeded 32 bit.")
 				seed = seed + 1
 				k = 0
 				slots = []
+				slotsMarked = set()
 				nCollisions = nCollisions + 1
 			else:
 				slots.append(slot)
+				slotsMarked.add(slot)
 				k = k + 1
 		# found a matching seed: record it in G and spread bucket to V
-		G[hashFNV1(bucket[0]) % nKeys] = seed
+		G[origin] = seed
 		for k,slot in enumerate(slots):
-			V[slot] = (bucket[k],source[bucket[k]])
+			VKeys[slot] = bucket[k]
+			VBits[slot] = source[bucket[k]]
+			occupied[slot] = 1
 			nCheck = nCheck + 1
 	
 	# step 4) process buckets with single key: place in remaining slots
 	#         mark this with a negative value in the intermediate table
 	
-	k = 0
-	while len(buckets) > 0 and len(buckets[0]) > 0:
-		bucket = buckets.pop(0)
-		# iterate over V to find the next free slot
-		while k < len(V):
-			if V[k] is None:
-				slot = k
-				break
-			else:
-				k = k + 1
-		if k >= len(V): raise IndexError("No free slots left.")
+	# collect the remaining free slots once, in ascending order
+	freeSlots = collections.deque(slot for slot in range(0,nKeys) if not occupied[slot])
+	for origin in order[iOrder:]:
+		bucket = buckets[origin]
+		if len(bucket) == 0: break # sorted buckets: only empty buckets left
+		if len(freeSlots) == 0: raise IndexError("No free slots left.")
+		slot = freeSlots.popleft()
 		# as this is a direct, one-hash-only mapping, mark the corresponding entry
 		# in the intermediate table with the negative target index
-		G[hashFNV1(bucket[0]) % nKeys] = -slot-1 # subtract one to ensure a negative value
-		V[slot] = (bucket[0],source[bucket[0]])
+		G[origin] = -slot-1 # subtract one to ensure a negative value
+		VKeys[slot] = bucket[0]
+		VBits[slot] = source[bucket[0]]
 		nCheck = nCheck + 1
 	
-	# finally, return lists G and V, defining a perfectly and minimally hashed hash table
+	# finally, return G and V, defining a perfectly and minimally hashed hash table
 	if (nKeys == nCheck):
-		return G,V,nCollisions
+		return G,VKeys,VBits,nCollisions
 	else:
 		# checksum mismatch!
 		raise ValueError("Mismatch between number of keys and number of processed keys.")
 
 
-def lookUp(nKeys,G,V,key):
-	g = G[hashFNV1(key) % nKeys]
-	if g < 0:
-		# direct look-up
-		v = -g-1
-	else:
-		v = hashFNV1(key,g) % nKeys
-	if (V[v][0] == key):
-		return V[v][1]
+def lookUpSlot(nKeys,G,VKeys,key):
+	# return the value table index of key; negative G entries are direct look-ups
+	g = G[hashFNV1Code(key) % nKeys]
+	v = -g-1 if g < 0 else hashFNV1Code(key,g) % nKeys
+	if (VKeys[v] == key):
+		return v
 	else:
 		raise KeyError
 
 
-def loadFile(args):
+def lookUp(nKeys,G,VKeys,VBits,key):
+	return VBits[lookUpSlot(nKeys,G,VKeys,key)]
+
+
+class FileTable:
+	# read-only view of a table in a faFF: an entry is read from the file when it
+	# is accessed and converted with function; allows look-ups without loading
+	def __init__(self,infile,offset,sizeEntry,function):
+		self.infile = infile
+		self.offset = offset
+		self.sizeEntry = sizeEntry
+		self.function = function
+	
+	def __getitem__(self,index):
+		self.infile.seek(self.offset + index * self.sizeEntry)
+		return self.function(self.infile.read(self.sizeEntry))
+
+
+def loadFile(args,lazy=False):
 	# read the input file, build the font dictionary
+	# lazy: don't load the tables, return FileTable views on a seekable file instead
 	print("Reading input file {}...".format(args.infile.name))
 	if args.infile.read(2) != b"\xfa\xff":
 		raise ValueError("File signature not found.")
@@ -163,21 +210,40 @@ def loadFile(args):
 	print("symbol dimensions: {}x{} pixels".format(width,height))
 	print("number of characters: {}".format(nChars))
 	
-	# read intermediate table G
-	G = [ struct.unpack(">i",args.infile.read(4))[0] for i in range(0,nChars)]
-	
-	# read value table V
 	sizeEntryV = width * ((height-1) // 8 + 1)
 	strFormatV = ">3s{}s".format(sizeEntryV)
 	sizeEntryV = sizeEntryV + 3
-	V = [ struct.unpack(strFormatV,args.infile.read(sizeEntryV)) for i in range(0,nChars)]
 	
-	return width,height,nChars,G,V
+	if lazy and args.infile.seekable():
+		# check that both tables fit into the file, then just map them
+		offsetV = 8 + 4*nChars
+		sizeFile = offsetV + sizeEntryV*nChars
+		if args.infile.seek(0,os.SEEK_END) < sizeFile:
+			raise struct.error("file size of at least {} bytes required".format(sizeFile))
+		G = FileTable(args.infile,8,4,lambda entry: struct.unpack(">i",entry)[0])
+		VKeys = FileTable(args.infile,offsetV,sizeEntryV,lambda entry: int.from_bytes(entry[:3],"big"))
+		VBits = FileTable(args.infile,offsetV,sizeEntryV,lambda entry: entry[3:])
+		return width,height,nChars,G,VKeys,VBits
+	
+	# read intermediate table G
+	# both tables are read and unpacked in one go
+	G = array.array("i",struct.unpack(">{}i".format(nChars),args.infile.read(4*nChars)))
+	
+	# read value table V
+	dataV = args.infile.read(sizeEntryV*nChars)
+	if len(dataV) != sizeEntryV*nChars:
+		# iter_unpack() would silently accept a table truncated to whole entries
+		raise struct.error("unpack requires a buffer of {} bytes".format(sizeEntryV*nChars))
+	entriesV = list(struct.iter_unpack(strFormatV,dataV))
+	VKeys = array.array("l",(int.from_bytes(key,"big") for key,bitmap in entriesV))
+	VBits = [ bitmap for key,bitmap in entriesV ]
+	
+	return width,height,nChars,G,VKeys,VBits
 
 
-def loadAndCheckFile(args):
+def loadAndCheckFile(args,lazy=False):
 	try:
-		width,height,nChars,G,V = loadFile(args)
+		width,height,nChars,G,VKeys,VBits = loadFile(args,lazy)
 	except ValueError as e:
 		print("File signature not found.")
 		raise e
@@ -193,20 +259,20 @@ def loadAndCheckFile(args):
 	
 	if args.verbose:
 		print("\nIntermediate table G:")
-		pprint.pprint(G)
+		pprint.pprint(G.tolist())
 		print("\nValue table V:")
-		pprint.pprint(V)
+		pprint.pprint(list(zip(VKeys,VBits)))
 		print("")
 	
 	# check that the Unicode replacement character U+FFFD is defined
 	try:
-		lookUp(nChars,G,V,b"\x00\xff\xfd")
+		lookUp(nChars,G,VKeys,VBits,UCODEREPLACEMENT)
 	except KeyError:
 		print("Unicode replacement character at U+FFFD is not defined! Font definition is incomplete!")
 		raise
 	print("Unicode replacement character at U+FFFD is defined.")
 	
-	return width,height,nChars,G,V
+	return width,height,nChars,G,VKeys,VBits
 
 
 def rangePixels(arg):
@@ -261,6 +327,8 @@ def createFile(args):
 					raise IndexError("Image dimensions not a multiple of the symbol dimensions.")
 				widthTiles = img.width // width
 				numTiles = widthTiles * img.height // height
+				pixels = img.tobytes() # greyscale: one byte per pixel, row by row
+				sizeTileRow = img.width * height # number of pixels in a row of tiles
 			except (IndexError,OSError) as e:
 				print("Invalid image file encountered.")
 				print("Reason: {}".format(e))
@@ -283,15 +351,21 @@ def createFile(args):
 				if uCode > 0:
 					try:
 						# valid code found; process it; iCode stores the current code index
-						uCodeBytes = uCode.to_bytes(3,"big")
-						dictFont[uCodeBytes] = b""
+						if iCode >= numTiles: raise IndexError
 						tx = iCode % widthTiles
 						ty = iCode // widthTiles
+						# pixel data range of the tile's row of tiles, constant for all columns
+						start = ty * sizeTileRow
+						end = start + sizeTileRow
+						columnWords = []
 						for x in range(tx*width, (tx+1)*width):
-							bitmask = 0
-							for y in range(ty*height, (ty+1)*height):
-								bitmask = bitmask | (bool(img.getpixel((x,y))) << (y % height))
-							dictFont[uCodeBytes] = dictFont[uCodeBytes] + bitmask.to_bytes(sizeColumnWord,"little")
+							# slice the tile's column x from the pixel data (top to bottom),
+							# map it to binary digits and reverse it: the bottom row
+							# becomes the most significant bit of the column word
+							column = pixels[start + x : end : img.width]
+							bitmask = int(column.translate(PIXELDIGITS)[::-1],2)
+							columnWords.append(bitmask.to_bytes(sizeColumnWord,"little"))
+						dictFont[uCode] = b"".join(columnWords)
 					except IndexError:
 						print("{}: read beyond image (more character codes than tiles).".format(filename))
 						print("No output written. Bye.")
@@ -322,7 +396,7 @@ def createFile(args):
 	
 	print("Creating minimal perfect hashing...")
 	try:
-		G,V,nCollisions = createMinimalPerfectHash(dictFont)
+		G,VKeys,VBits,nCollisions = createMinimalPerfectHash(dictFont)
 	except (IndexError,ValueError) as e:
 		print("Sorry, could not find a minimal perfect hash function for that character set.")
 		print("Reason: {}".format(e))
@@ -332,32 +406,12 @@ def createFile(args):
 	
 	print("Checking that replacement character is defined...")
 	try:
-		lookUp(len(G),G,V,b"\x00\xff\xfd")
+		lookUp(len(G),G,VKeys,VBits,UCODEREPLACEMENT)
 	except KeyError:
 		print("Unicode replacement character at U+FFFD is not defined! Font definition is incomplete!")
 		return 1
 	print("Unicode replacement character at U+FFFD is defined.")
 	
-	# prepare output bytes
-	output = bytearray()
-	# first four bytes: signature (fa FF for faFontFile in hex) + char width + char height
-	output.extend(b"\xfa\xff")
-	output.extend((width).to_bytes(1,"big"))
-	output.extend((height).to_bytes(1,"big"))
-	# next four bytes: number of entries, uint32_t, big-endian
-	output.extend((len(G)).to_bytes(4,"big"))
-	# append G table as array of int32_t, big-endian
-	
-	for g in G:
-		# in case of negative values: calculate 32 bit twos complement = 2*32 + value
-		if g < 0: g = 0x100000000 + g
-		output.extend(g.to_bytes(4,"big"))
-	
-	# append V table as array of uint8_t[3] + bitmap format depending on char dimensions
-	for v in V:
-		output.extend(v[0])
-		output.extend(v[1])
-	
 	if args.outfile is None:
 		args.outfile = args.infile.name.rsplit(".",1)[0] + "." + args.suffix
 	
@@ -365,7 +419,15 @@ def createFile(args):
 		with open(args.outfile,"wb") as outfile:
 			print("Writing output file {}...".format(outfile.name))
 			try:
-				outfile.write(output)
+				# write output directly, no intermediate buffer
+				# first four bytes: signature (fa FF for faFontFile in hex) + char width + char height
+				# next four bytes: number of entries, uint32_t, big-endian
+				outfile.write(b"\xfa\xff" + struct.pack(">BBI",width,height,len(G)))
+				# append G table as array of int32_t, big-endian (packed in one go;
+				# struct takes care of the two's complement of negative values)
+				outfile.write(struct.pack(">{}i".format(len(G)),*G))
+				# append V table as array of uint8_t[3] + bitmap format depending on char dimensions
+				outfile.writelines(key.to_bytes(3,"big") + bitmap for key,bitmap in zip(VKeys,VBits))
 			except OSError as e:
 				print("Error opening file for writing.")
 				raise e
@@ -386,7 +448,8 @@ def createFile(args):
 
 def checkFile(args):
 	try:
-		width,height,nChars,G,V = loadAndCheckFile(args)
+		# unless the tables are printed, only read the entries needed for the check
+		width,height,nChars,G,VKeys,VBits = loadAndCheckFile(args,lazy=not args.verbose)
 	except Exception as e:
 		print("File check failed.")
 		print(e)
@@ -405,7 +468,7 @@ def checkFile(args):
 def renderString(args):
 	# step 1: check input file
 	try:
-		width,height,nChars,G,V = loadAndCheckFile(args)
+		width,height,nChars,G,VKeys,VBits = loadAndCheckFile(args)
 	except Exception as e:
 		print("File check failed.")
 		args.infile.close()
@@ -417,8 +480,6 @@ def renderString(args):
 	# prepare image surface
 	widthImage = width * len(args.text) + args.distance * (len(args.text)-1) + 2 * args.margin
 	heightImage = height + 2 * args.margin
-	xCursor = args.margin
-	yCursor = args.margin
 	sizeWord = (height-1)//8 + 1
 	formatBits = ">{}s".format(sizeWord)
 	
@@ -431,18 +492,31 @@ def renderString(args):
 		img = PIL.Image.new("L",(widthImage,heightImage),color=0)
 		colourFg = 255
 	
-	# iterate over string, paint symbols
+	# resolve the value table slots of all characters first; undefined characters
+	# are mapped to the replacement character, which is looked up only once
+	slotReplacement = lookUpSlot(nChars,G,VKeys,UCODEREPLACEMENT)
+	slots = []
 	for character in args.text:
 		try:
-			bitmap = lookUp(nChars,G,V,ord(character).to_bytes(3,"big"))
+			slots.append(lookUpSlot(nChars,G,VKeys,ord(character)))
 		except KeyError:
-			bitmap = lookUp(nChars,G,V,b"\x00\xff\xfd")
-		for x in range(0,width):
-			for y in range(0,height):
-				if (bitmap[x*sizeWord + (y >> 3)] & (1 << (y & 7))):
-					img.putpixel((xCursor+x,yCursor+y),colourFg)
-		
-		xCursor = xCursor + width + args.distance
+			slots.append(slotReplacement)
+	
+	# decode each distinct glyph once: read the bitmap as bilevel image with one
+	# column word per line (bits ordered least significant first, i.e. raw mode
+	# "1;R"), then crop the padding bits and transpose
+	glyphs = {}
+	for slot in set(slots):
+		glyph = PIL.Image.frombytes("1",(8*sizeWord,width),VBits[slot],"raw","1;R")
+		glyphs[slot] = glyph.crop((0,0,height,width)).transpose(PIL.Image.TRANSPOSE)
+	
+	# compose the string as one bilevel mask, then paint it with a single paste
+	if len(slots) > 0:
+		mask = PIL.Image.new("1",(widthImage-2*args.margin,height))
+		advance = width + args.distance
+		for i,slot in enumerate(slots):
+			mask.paste(glyphs[slot],(i*advance,0))
+		img.paste(colourFg,(args.margin,args.margin),mask)
 	
 	img.show()
 	return 0